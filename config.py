@@ -1,59 +1,152 @@
+import functools
 import os
 import threading
+import time
 
-from dotenv import dotenv_values
-from pydantic import BaseModel, Field
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 from watchdog.observers.polling import PollingObserver
 
+DEFAULT_POLL_INTERVAL = 30.0
+# window (in seconds) in which bursts of editor writes are coalesced
+DEBOUNCE_INTERVAL = 0.2
+# filesystems on which inotify does not see changes made by other hosts
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smbfs", "smb3", "sshfs", "fuse.sshfs"}
+
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=".env", extra="ignore", env_ignore_empty=True
+    )
 
-class Settings(BaseModel):
     app_name: str = Field(description="应用名称")
     admin_email: str = Field(description="管理员邮箱")
     items_per_user: int = Field(description="每个用户配额")
+    config_poll_interval: float = Field(
+        default=DEFAULT_POLL_INTERVAL, description="配置文件轮询间隔（秒）"
+    )
+
+    @classmethod
+    def settings_customise_sources(
+        cls,
+        settings_cls,
+        init_settings,
+        env_settings,
+        dotenv_settings,
+        file_secret_settings,
+    ):
+        # only read the .env file, exported variables must not shadow its edits
+        return init_settings, dotenv_settings
 
 
 def load_settings(env_path=".env") -> Settings:
-    envs = dotenv_values(env_path)
-    config = {
-        "app_name": envs.get("APP_NAME"),
-        "admin_email": envs.get("ADMIN_EMAIL"),
-        "items_per_user": int(envs.get("ITEMS_PER_USER")),
-    }
-    return Settings(**config)
+    return _load_settings_cached(env_path, os.stat(env_path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_settings_cached(env_path, mtime) -> Settings:
+    return Settings(_env_file=env_path)
 
 
 class EnvHandler(FileSystemEventHandler):
     def __init__(self, env_path, on_reload):
         self.env_path = env_path
+        self._abs_env_path = os.path.abspath(env_path)
         self.on_reload = on_reload
+        self._lock = threading.Lock()
+        self._timer = None
+        self._last_fire = 0.0
+        self._last_mtime = None
         self.load_config()
 
     def load_config(self):
-        settings = load_settings(self.env_path)
-        self.on_reload(settings)
+        with self._lock:
+            self._last_fire = time.monotonic()
+            try:
+                mtime = os.stat(self.env_path).st_mtime_ns
+            except FileNotFoundError:
+                # the editor is replacing the file, the next event reloads it
+                if self._last_mtime is None:
+                    raise
+                return
+            if mtime == self._last_mtime:
+                return
+            settings = load_settings(self.env_path)
+            self._last_mtime = mtime
+            self.on_reload(settings)
         print(f"Config reloaded: {settings}")
 
+    def schedule_reload(self):
+        """Reload on the first event, coalesce the rest of the burst"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            delay = self._last_fire + DEBOUNCE_INTERVAL - time.monotonic()
+            self._timer = threading.Timer(max(0.0, delay), self.load_config)
+            self._timer.daemon = True
+            self._timer.start()
+
     def on_modified(self, event):
-        if event.src_path == os.path.abspath(self.env_path):
+        if event.is_directory:
+            return
+        if event.src_path == self._abs_env_path:
             print(f"Config file {event.src_path} has been modified")
-            self.load_config()
+            self.schedule_reload()
 
+    def on_created(self, event):
+        self.on_modified(event)
 
-def start_watchdog(env_path, on_reload):
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        # editors that save via rename move a temp file onto the config
+        if event.dest_path == self._abs_env_path:
+            print(f"Config file {event.dest_path} has been replaced")
+            self.schedule_reload()
+
+
+def is_network_fs(path):
+    """Check whether path lives on a network filesystem (Linux only)"""
+    try:
+        with open("/proc/mounts", encoding="utf8") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    fs_type, best = None, ""
+    for mount_point, mount_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        prefix = mount_point.rstrip("/") + "/"
+        if (path == mount_point or path.startswith(prefix)) and len(
+            mount_point
+        ) > len(best):
+            fs_type, best = mount_type, mount_point
+    return fs_type in NETWORK_FS_TYPES
+
+
+def start_watchdog(
+    env_path, on_reload, poll_interval: float = DEFAULT_POLL_INTERVAL
+):
     event_handler = EnvHandler(env_path, on_reload)
-    observer = PollingObserver()
 
     # Ensure the directory is correct and add some debug information
     directory = os.path.dirname(os.path.abspath(env_path))
     print(f"Monitoring directory: {directory}")
 
-    observer.schedule(event_handler, path=directory, recursive=False)
-    observer.start()
-
-    def run_observer():
-        observer.join()
-
-    thread = threading.Thread(target=run_observer)
-    thread.daemon = True
-    thread.start()
+    observer = None
+    if not is_network_fs(directory):
+        try:
+            observer = Observer()
+            observer.schedule(event_handler, path=directory, recursive=False)
+            observer.start()
+        except OSError as e:
+            print(f"Native observer unavailable ({e}), falling back to polling")
+            observer = None
+    if observer is None:
+        observer = PollingObserver(timeout=poll_interval)
+        observer.schedule(event_handler, path=directory, recursive=False)
+        observer.start()
+    # the observer runs in its own thread, the caller stops and joins it
+    return observer
@@ -4,21 +4,36 @@
 """A tool to create a feedstock directly from a conda-forge package"""
 
 import argparse
-import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import os
 import shutil
-import urllib.request
+import sys
+import threading
 import urllib.parse
 import re
-import tempfile
 import tarfile
 
+import orjson
+import requests
 import ruamel.yaml
 import zstandard
 from colorama import Fore, Style
-from packaging.version import parse as PV
+from packaging.version import InvalidVersion, parse as PV
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# shared session, keeps connections to the mirrors alive between downloads
+SESSION = requests.Session()
+_adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+# save files byte for byte, a decoded body would not match its checksum
+SESSION.headers["Accept-Encoding"] = "identity"
 
 fn_is_simple = re.compile(r"^v?\d+([\-.]\d+)+(\.\w+)+$").match
+url_regex = re.compile(r"(^\s*-?\s*url:\s*)([^{]+)\{\{.*\}\}([^}]+)$")
+req_keys = frozenset(("host:", "run:", "build:", "run_constrained:"))
 
 
 def load_urls(meta_yaml):
@@ -50,7 +65,6 @@ def load_urls(meta_yaml):
 
 
 def replace_urls(meta_yaml_tpl, urls, pkgs_dir):
-    url_regex = re.compile(r"(^\s*-?\s*url:\s*)([^{]+)\{\{.*\}\}([^}]+)$")
     with open(meta_yaml_tpl) as f:
         content = f.read().split("\n")
     result = []
@@ -61,12 +75,8 @@ def replace_urls(meta_yaml_tpl, urls, pkgs_dir):
             continue
         head = m.group(2)
         tail = m.group(3)
-        url_pattern = re.escape(head) + r".*" + re.escape(tail)
-        new_url = None
-        for u in urls.keys():
-            if re.match(url_pattern, u):
-                new_url = u
-                break
+        url_pattern = re.compile(re.escape(head) + r".*" + re.escape(tail))
+        new_url = next((u for u in urls if url_pattern.match(u)), None)
         if new_url is None:
             print(f"!! URL at {line.strip()!r} not found")
             result.append(line)
@@ -78,6 +88,8 @@ def replace_urls(meta_yaml_tpl, urls, pkgs_dir):
         pkg_path = os.path.relpath(pkg_path, os.path.dirname(meta_yaml_tpl))
         result.append("#" + m.group())
         result.append(m.group(1) + pkg_path)
+    # break a possible hardlink to the extracted recipe before rewriting
+    os.remove(meta_yaml_tpl)
     with open(meta_yaml_tpl, "w", encoding="utf8") as f:
         f.write("\n".join(result))
 
@@ -85,7 +97,6 @@ def replace_urls(meta_yaml_tpl, urls, pkgs_dir):
 def extract_reqs(meta_yaml):
     with open(meta_yaml) as f:
         content = f.read().split("\n")
-    keys = ("host:", "run:", "build:", "run_constrained:")
     in_req = False
     result = []
     for line in content:
@@ -106,18 +117,24 @@ def extract_reqs(meta_yaml):
             if line.startswith("-"):
                 result.append(line)
                 continue
-            if line.endswith(":") and line not in keys:
+            if line.endswith(":") and line not in req_keys:
                 in_req = False
                 continue
             result.append(line)
     return "\n".join(result)
 
 
-def download_file(url, fn):
+def show_progress(out, done, interval=0.5):
+    """Print the size written to out until done is set"""
+    while not done.wait(interval):
+        print(f"\roo {out.tell() / 2**20:.1f} MiB", end="", flush=True)
+
+
+def download_file(url, fn, progress=True):
     # github 代理
     # if "github" in url:
     #     url = os.path.join("https://github.moeyy.xyz/", url)
-    CHUNK_SIZE = 64 * 1024
+    CHUNK_SIZE = 1024 * 1024
     dest = os.path.dirname(fn)
     basefn = os.path.basename(fn)
     os.makedirs(dest, exist_ok=True)
@@ -125,23 +142,48 @@ def download_file(url, fn):
     netloc = url_segs.netloc
     with open(fn, "wb") as out:
         print(f"{Fore.YELLOW}oo Connecting to {netloc}")
-        with urllib.request.urlopen(url) as f:
-            print(f"oo Downloading {basefn} from {url}\noo ", end="", flush=True)
-            print(f"oo Downloading {basefn} to {dest}\noo ", end="", flush=True)
-            blocks = 0
-            while True:
-                s = f.read(CHUNK_SIZE)
-                if len(s) == 0:
-                    break
-                print(".", end="", flush=True)
-                blocks += 1
-                if blocks == 77:
-                    print("\noo ", flush=True, end="")
-                    blocks = 0
-                out.write(s)
+        with SESSION.get(url, stream=True) as r:
+            r.raise_for_status()
+            print(f"oo Downloading {basefn} from {url}")
+            print(f"oo Downloading {basefn} to {dest}", flush=True)
+            done = threading.Event()
+            reporter = threading.Thread(
+                target=show_progress, args=(out, done), daemon=True
+            )
+            if progress and sys.stdout.isatty():
+                reporter.start()
+            try:
+                shutil.copyfileobj(r.raw, out, length=CHUNK_SIZE)
+            finally:
+                done.set()
+                if reporter.is_alive():
+                    reporter.join()
+            print(f"\roo {out.tell() / 2**20:.1f} MiB", end="")
     print(f"\noo File saved to {fn}{Style.RESET_ALL}")
 
 
+def link_or_copy(src, dst):
+    """Hardlink src to dst, copy it if they are on different devices"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def file_hash_matches(fn, hash_type, expected):
+    """Check whether an existing file has the expected hash"""
+    if not os.path.isfile(fn):
+        return False
+    with open(fn, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            digest = hashlib.file_digest(f, hash_type)
+        else:
+            digest = hashlib.new(hash_type)
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    return digest.hexdigest() == str(expected).lower()
+
+
 def url_basename(url):
     return os.path.basename(urllib.parse.urlparse(url).path)
 
@@ -156,11 +198,9 @@ def extract_zst(archive, out_path):
     out_path = os.path.abspath(out_path)
     dctx = zstandard.ZstdDecompressor()
 
-    with tempfile.TemporaryFile(suffix=".tar") as ofh:
-        with open(archive, "rb") as ifh:
-            dctx.copy_stream(ifh, ofh)
-        ofh.seek(0)
-        with tarfile.open(fileobj=ofh) as z:
+    # "r|" reads the tar as a non-seekable stream, straight from the decompressor
+    with open(archive, "rb") as ifh, dctx.stream_reader(ifh) as reader:
+        with tarfile.open(fileobj=reader, mode="r|") as z:
             z.extractall(out_path)
 
 
@@ -186,8 +226,8 @@ def extract_archive(archive, out_path, format="zip"):
 
 
 def get_pkg_spec(pkg, ver, py, pkg_db):
-    with open(pkg_db) as f:
-        pkg_db = json.load(f)
+    with open(pkg_db, "rb") as f:
+        pkg_db = orjson.loads(f.read())
     if pkg not in pkg_db:
         raise ValueError(f"Requested package {pkg} is not in database")
     pkg_specs = pkg_db[pkg]
@@ -203,10 +243,14 @@ def get_pkg_spec(pkg, ver, py, pkg_db):
         pkg_spec = pkg_specs[-1]  # the newest version
     else:
         pkg_spec = None
+        upper_bound = PV(ver)
         for p in reversed(pkg_specs):
-            if PV(p["version"]) <= PV(ver):
-                pkg_spec = p
-                break
+            try:
+                if PV(p["version"]) <= upper_bound:
+                    pkg_spec = p
+                    break
+            except InvalidVersion:
+                continue
         if pkg_spec is None:
             raise ValueError(f"version {ver} of {pkg} is not found in the db")
     return pkg_spec
@@ -254,12 +298,12 @@ def create_feedstock(
             + f"correct its name{Style.RESET_ALL}"
         )
         real_recipe = os.path.join(old_recipe, "parent")
-        shutil.copytree(real_recipe, new_recipe)
+        shutil.copytree(real_recipe, new_recipe, copy_function=link_or_copy)
         meta_yaml = os.path.join(old_recipe, "meta.yaml")
         meta_yaml_tpl = os.path.join(new_recipe, "meta.yaml")
     else:
         print(f">> Copying recipe to {new_recipe} ...")
-        shutil.copytree(old_recipe, new_recipe)
+        shutil.copytree(old_recipe, new_recipe, copy_function=link_or_copy)
         conda_build_cfg = os.path.join(new_recipe, "conda_build_config.yaml")
         meta_yaml = os.path.join(new_recipe, "meta.yaml")
         meta_yaml_tpl = os.path.join(new_recipe, "meta.yaml.template")
@@ -268,13 +312,26 @@ def create_feedstock(
             os.remove(conda_build_cfg)
     print(f">> Downloading packages to {pkgs_dir} ...")
     urls = load_urls(meta_yaml)
+    tasks = []
     for url, v in urls.items():
         fn = v[2] if v[2] is not None else url_basename(url)
         fn = f"{pkg}-{fn}" if fn_is_simple(fn) else fn
         v[2] = fn  # fix the destination filename
         full_fn = os.path.join(pkgs_dir, fn)
-        # TODO: validate hash, if exists then skip download
-        download_file(url, full_fn)
+        if file_hash_matches(full_fn, v[0], v[1]):
+            print(f"oo {fn} already downloaded, skipping")
+            continue
+        tasks.append((url, full_fn))
+    if tasks:
+        # progress output of concurrent downloads would interleave
+        progress = len(tasks) == 1
+        with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as ex:
+            futures = [
+                ex.submit(download_file, url, full_fn, progress)
+                for url, full_fn in tasks
+            ]
+            for future in futures:
+                future.result()
     print(f">> Replacing urls in {meta_yaml_tpl} ...")
     replace_urls(meta_yaml_tpl, urls, pkgs_dir)
     if os.path.exists(os.path.join(old_recipe, "parent")):
@@ -1,22 +1,36 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from config import Settings, load_settings, start_watchdog
 
-app = FastAPI()
-settings: Settings = load_settings()
+# a single-item list, swapped atomically so a request sees one snapshot
+_settings_ref: list[Settings] = [load_settings()]
 
 
 def reload_settings(new_settings: Settings):
-    global settings
-    settings = new_settings
+    _settings_ref[0] = new_settings
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the watchdog to monitor config changes
+    observer = start_watchdog(
+        ".env", reload_settings, _settings_ref[0].config_poll_interval
+    )
+    try:
+        yield
+    finally:
+        observer.stop()
+        observer.join()
 
 
-# Start the watchdog to monitor config changes
-start_watchdog(".env", reload_settings)
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/info")
 async def get_info():
+    settings = _settings_ref[0]
     return {
         "app_name": settings.app_name,
         "admin_email": settings.admin_email,
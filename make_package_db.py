@@ -4,39 +4,72 @@
 """Create a package database for newest packages from conda-forge channel"""
 
 import argparse
-import json
 import os
-import urllib.request
 import bz2
-from packaging.version import parse as PV
+import functools
+from packaging.version import InvalidVersion, parse as PV
 from collections import defaultdict
 
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 DEFAULT_CONDA_FORGE_URL = "https://mirrors.nju.edu.cn/anaconda/cloud/conda-forge/"
 # DEFAULT_CONDA_FORGE_URL = "https://conda.anaconda.org/conda-forge"
 DEFAULT_ARCHES = ["linux-64", "noarch"]
 #  "linux-aarch64"
 
+# one session for all arches so the mirror connection is reused,
+# connection errors are retried before giving up
+SESSION = requests.Session()
+for prefix in ("https://", "http://"):
+    SESSION.mount(
+        prefix, HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5))
+    )
+# bz2.BZ2File reads r.raw undecoded, a gzip-encoded body would not be bz2
+SESSION.headers["Accept-Encoding"] = "identity"
+
+# version strings repeat a lot across packages, parse each only once
+pv_cached = functools.lru_cache(maxsize=None)(PV)
+
 
-def load_repodata(arches, forge_url):
-    data = {}
+def load_repodata(arches, forge_url, raw_out=None):
+    """Build the package database arch by arch, optionally caching the raw data"""
+    pkg_db = defaultdict(list)
+    raw = {} if raw_out else None
     for arch in arches:
         url = os.path.join(forge_url, f"{arch}/repodata.json.bz2")
         print(f"Connecting to {url} ...")
-        with urllib.request.urlopen(url) as f:
-            print(f"Loading {url} ...")
-            repodata = bz2.decompress(f.read())
-            print(f"Parsing {url} ...")
-            repodata = json.loads(repodata)
-            data.update(repodata["packages"])
-            data.update(repodata["packages.conda"])
-    with open("../data/data.json", "w", encoding="utf8", newline="\n") as f:
-        json.dump(data, f)
-    return data
-
-
-def parse_repodata(data, out, forge_url):
-    print("Extracting package database ...")
-    pkg_db = defaultdict(list)
+        with SESSION.get(url, stream=True) as r:
+            r.raise_for_status()
+            print(f"Loading and parsing {url} ...")
+            with bz2.BZ2File(r.raw) as bz:
+                repodata = orjson.loads(bz.read())
+        print(f"Extracting packages of {arch} ...")
+        for key in ("packages", "packages.conda"):
+            parse_repodata(repodata[key], pkg_db, forge_url)
+            if raw is not None:
+                raw.update(repodata[key])
+        del repodata
+    if raw is not None:
+        print(f"Writing raw repodata to {raw_out}")
+        with open(raw_out, "wb") as f:
+            f.write(orjson.dumps(raw))
+    return pkg_db
+
+
+def sort_versions(specs):
+    """Sort package entries by version, falling back to plain strings"""
+    try:
+        versions = [pv_cached(x["version"]) for x in specs]
+    except InvalidVersion:
+        return sorted(specs, key=lambda x: (x["version"], x["timestamp"], x["build"]))
+    order = sorted(range(len(specs)), key=versions.__getitem__)
+    return [specs[i] for i in order]
+
+
+def parse_repodata(data, pkg_db, forge_url):
     for pn, p in data.items():
         n = p["name"]
         v = p["version"]
@@ -54,16 +87,15 @@ def parse_repodata(data, out, forge_url):
                 "build": b,
             }
         )
+    return pkg_db
+
+
+def write_package_db(pkg_db, out):
     for k, v in pkg_db.items():
-        try:
-            pkg_db[k] = sorted(v, key=lambda x: PV(x["version"]))
-        except Exception:
-            pkg_db[k] = sorted(
-                v, key=lambda x: (x["version"], x["timestamp"], x["build"])
-            )
+        pkg_db[k] = sort_versions(v)
     print(f"Writing package database to {out}")
-    with open(out, "w", encoding="utf8", newline="\n") as f:
-        json.dump(pkg_db, f, indent=2)
+    with open(out, "wb") as f:
+        f.write(orjson.dumps(pkg_db, option=orjson.OPT_INDENT_2))
 
 
 def main():
@@ -87,15 +119,24 @@ def main():
         default=DEFAULT_CONDA_FORGE_URL,
         help="Conda forge url (default: %(default)s",
     )
+    parser.add_argument(
+        "--cache-raw",
+        action="store_true",
+        help="Also save the merged raw repodata to ../data/data.json",
+    )
     args = parser.parse_args()
 
     exist_data_fn = "../data/data.json"
     if os.path.exists(exist_data_fn):
-        with open(exist_data_fn, "r", encoding="utf8") as fin:
-            data = json.load(fin)
+        with open(exist_data_fn, "rb") as fin:
+            data = orjson.loads(fin.read())
+        print("Extracting package database ...")
+        pkg_db = parse_repodata(data, defaultdict(list), args.CONDA_FORGE_URL)
+        del data
     else:
-        data = load_repodata(args.ARCHES, args.CONDA_FORGE_URL)
-    parse_repodata(data, args.output, args.CONDA_FORGE_URL)
+        raw_out = exist_data_fn if args.cache_raw else None
+        pkg_db = load_repodata(args.ARCHES, args.CONDA_FORGE_URL, raw_out)
+    write_package_db(pkg_db, args.output)
 
 
 if __name__ == "__main__":